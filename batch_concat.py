@@ -6,13 +6,16 @@ import sys
 import os
 from pathlib import Path
 import re
+import glob
 import shutil
-from collections import defaultdict
+from datetime import datetime
+from collections import defaultdict, OrderedDict
 from configparser import ConfigParser
 import click
 import pandas as pd
 from tqdm import tqdm # nice double progress bar
 from utils import *
+from watcher import GroupTable, make_watcher
 
 __version__ = '0.9.3'
 __author__  = 'Alexander Saltzman'
@@ -23,6 +26,9 @@ class Config(object):
 
     def __init__(self):
         self.groups = None
+        self.ignore = None
+        self.log = None
+        self.overrides = dict()  # settings given as cli flags
 
 class FileGroup(object):
 
@@ -123,28 +129,241 @@ class FileGroup(object):
 
 pass_config = click.make_pass_decorator(Config, ensure=True)
 
-def batch_concat(filegroups, outputdir=None, stout=None):
+def size_callback(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+class OutputWriter(object):
+    """Appends the filtered output of one filegroup to its output file,
+    or to a set of shards when the output is bounded by size or rows
+    or partitioned by a column. Everything is written to .part files
+    that are only moved into place by `finish`."""
+
+    sample_rows = 100  # rows used to estimate bytes per row when shards are bounded by size
+
+    def __init__(self, outputdir, name, max_bytes=None, max_rows=None, partition_by=None):
+        self.outputdir = outputdir
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.partition_by = partition_by
+        self.shards = OrderedDict()  # shard name -> [bytes, rows]
+        self.columns = None
+
+    @property
+    def sharded(self):
+        return bool(self.max_bytes or self.max_rows or self.partition_by)
+
+    @property
+    def mode(self):
+        """How the output is split, checkpointed so a resume can't mix modes"""
+        return 'bytes={} rows={} partition={}'.format(self.max_bytes, self.max_rows, self.partition_by)
+
+    @property
+    def manifest(self):
+        return '{}.manifest'.format(os.path.splitext(self.name)[0])
+
+    def shard_name(self, key):
+        base, ext = os.path.splitext(self.name)
+        return '{}.{}{}'.format(base, key, ext)
+
+    def partfile(self, shard):
+        return os.path.join(self.outputdir, shard + '.part')
+
+    def partfiles(self):
+        """Every .part file of this output in outputdir"""
+        base = glob.escape(os.path.join(self.outputdir, os.path.splitext(self.name)[0]))
+        return glob.glob(base + '*.part')
+
+    def clear(self):
+        """Remove partial output left over from a previous run"""
+        for partfile in self.partfiles():
+            os.remove(partfile)
+        self.shards.clear()
+        self.columns = None
+
+    def restore(self, shards):
+        """Pick up from checkpointed shards, dropping anything written
+        to them after the checkpoint and any shard started after it"""
+        keep = {self.partfile(shard) for shard in shards}
+        for partfile in self.partfiles():
+            if partfile not in keep:
+                os.remove(partfile)
+        for shard, (size, nrows) in shards.items():
+            with open(self.partfile(shard), 'r+b') as f:
+                f.truncate(size)
+            self.shards[shard] = [size, nrows]
+
+    def write(self, df):
+        """Append df to the output.
+        Returns a dict of each shard written to and its (bytes, rows) afterwards.
+        Raises ValueError if df has columns that are not in the output already written"""
+        df = self._line_up(df)
+        written = OrderedDict()
+        if not self.sharded:
+            written[self.name] = self._append(self.name, df)
+        elif self.partition_by:
+            col = identify_column(df.columns, re.compile(r'^{}$'.format(re.escape(self.partition_by)), re.I))
+            for key, part in df.groupby(df[col].astype(str), sort=False):
+                shard = self.shard_name(re.sub(r'[^\w.-]+', '_', key))
+                written[shard] = self._append(shard, part)
+        else:
+            while len(df):
+                shard = self._current_shard()
+                nrows = len(df)
+                if self.max_rows:
+                    nrows = min(nrows, self.max_rows - self.shards[shard][1])
+                if self.max_bytes:
+                    nrows = min(nrows, self._rows_for_bytes(shard, df))
+                written[shard] = self._append(shard, df.iloc[:nrows])
+                df = df.iloc[nrows:]
+        return written
+
+    def _line_up(self, df):
+        """Order the columns of df like the output, which has the header of the first file"""
+        if self.columns is None:
+            written = [x for x in self.shards if self.shards[x][0]]
+            if written:  # resumed, line up with the columns already written
+                self.columns = pd.read_table(self.partfile(written[0]), nrows=0).columns
+            else:
+                self.columns = df.columns
+        extra = [x for x in df.columns if x not in self.columns]
+        if extra:
+            raise ValueError('Columns not in the output already written : {}'.format(', '.join(map(str, extra))))
+        return df.reindex(columns=self.columns)
+
+    def _rows_for_bytes(self, shard, df):
+        """Rows of df that should fit in what is left of the shard's size bound.
+        Aims a little short so the shard overshoots by at most a row or so"""
+        sample = df.iloc[:self.sample_rows]
+        row_bytes = len(sample.to_csv(index=False, sep='\t', header=False).encode()) / len(sample)
+        budget = self.max_bytes - self.shards[shard][0]
+        if self.shards[shard][0] == 0:  # leave room for the header
+            budget -= len('\t'.join(map(str, df.columns)).encode()) + 1
+        return max(1, int(0.9 * budget / row_bytes))
+
+    def _current_shard(self):
+        """The last shard, or a new one if the last is full"""
+        if self.shards:
+            shard = next(reversed(self.shards))
+            size, nrows = self.shards[shard]
+            if not ((self.max_bytes and size >= self.max_bytes) or
+                    (self.max_rows and nrows >= self.max_rows)):
+                return shard
+        shard = self.shard_name('{:03d}'.format(len(self.shards) + 1))
+        self.shards[shard] = [0, 0]
+        return shard
+
+    def _append(self, shard, df):
+        partfile = self.partfile(shard)
+        size, nrows = self.shards.setdefault(shard, [0, 0])
+        with open(partfile, 'a', newline='') as f:
+            df.to_csv(f, index=False, sep='\t', header=(size == 0))
+            f.flush()
+            os.fsync(f.fileno())
+        self.shards[shard] = [os.path.getsize(partfile), nrows + len(df)]
+        return tuple(self.shards[shard])
+
+    def finish(self):
+        """Move all shards into place, followed by the manifest if sharded"""
+        for shard in self.shards:
+            os.replace(self.partfile(shard), os.path.join(self.outputdir, shard))
+        if self.sharded:
+            partfile = self.partfile(self.manifest)
+            with open(partfile, 'w') as f:
+                f.write('shard\trows\tbytes\n')
+                for shard, (size, nrows) in self.shards.items():
+                    f.write('{}\t{}\t{}\n'.format(shard, nrows, size))
+            os.replace(partfile, os.path.join(self.outputdir, self.manifest))
+        return list(self.shards)
+
+def resume_point(filegroup, writer, path=None):
+    """Returns the shards each already written file of `filegroup` went to,
+    and the (bytes, rows) of each shard of `writer` as of the last checkpoint.
+    Nothing is resumed if the checkpoints no longer match the files on disk
+    or were made with the output split into shards differently."""
+    checkpoints = get_checkpoints(filegroup.recno, filegroup.runno, filegroup.searchno, path=path)
+    files = {file.name: file for file in filegroup}
+    written, shards = OrderedDict(), OrderedDict()
+    for filename, filesize, filedate, shard, outputsize, shardrows, mode in checkpoints:
+        file = files.get(filename)
+        if (file is None or
+            mode != writer.mode or
+            file.stat().st_size != filesize or
+            datetime.fromtimestamp(file.stat().st_mtime) != filedate):
+            return dict(), dict()
+        written.setdefault(filename, list())
+        if shard is not None:
+            written[filename].append(shard)
+            shards[shard] = (outputsize, shardrows)
+    for shard, (size, _) in shards.items():
+        if size is None or not os.path.isfile(writer.partfile(shard)) \
+           or os.path.getsize(writer.partfile(shard)) < size:
+            return dict(), dict()
+    return written, shards
+
+def batch_concat(filegroups, outputdir=None, stout=None, resume=False, path=None,
+                 shard_size=None, shard_rows=None, partition_by=None, confirm=True,
+                 qvalue=0.05, rank=1, settings=None):
+    """Concatenate each filegroup into outputdir.
+    Output is written to .part files that are renamed once the whole group is done,
+    with a checkpoint logged after each input file so that a `resume` run
+    can pick up where an interrupted one stopped.
+    Output can be split into shards of at most `shard_size` bytes or
+    `shard_rows` rows, or one shard per value of the `partition_by` column.
+    `settings` are the resolved settings of the run, logged as a snapshot
+    once the run goes ahead."""
+    if outputdir is None:
+        outputdir = '.'
     for filegroup in filegroups:
-        display(filegroup)
-    if not click.confirm('Would you like to proceed'):
+        display(filegroup, stout=stout)
+    if confirm and not click.confirm('Would you like to proceed'):
         click.echo('Exiting..', file=stout)
         sys.exit(0)
+    snapshot = None
+    if settings is not None:
+        snapshot = insert_snapshot(settings, path=path)
     for filegroup in tqdm(filegroups, desc='Total groups'):
-        data = list()
-        for file in tqdm(filegroup, desc=filegroup.name):
-            df = pd.read_table(file.absolute())
-            data.append(filter_output(df))
-            df = pd.concat(data)
-            df.to_csv(os.path.join(outputdir, filegroup.name), index=False, sep='\t')
+        writer = OutputWriter(outputdir, filegroup.name, max_bytes=shard_size,
+                              max_rows=shard_rows, partition_by=partition_by)
+        written = dict()
+        if resume:
+            written, shards = resume_point(filegroup, writer, path=path)
+        if written:
+            click.echo('Resuming {} after {} of {} files'.format(filegroup.name,
+                                                                 len(written),
+                                                                 len(filegroup)), file=stout)
+            writer.restore(shards)
+        else:
+            delete_checkpoints(filegroup.recno, filegroup.runno, filegroup.searchno, path=path)
+            writer.clear()
+        todo = [file for file in filegroup if file.name not in written]
+        for file in tqdm(todo, desc=filegroup.name, total=len(filegroup), initial=len(written)):
+            df = filter_output(pd.read_table(file.absolute()), qvalue=qvalue, rank=rank)
+            try:
+                shards = writer.write(df)
+            except ValueError as e:
+                raise ValueError('{} : {}'.format(file.name, e))
+            insert_checkpoint(filegroup, file, shards, path=path, mode=writer.mode)
+            written[file.name] = list(shards)
+        writer.finish()
 
         if filegroup.updating:
-            update_recrun(filegroup.recno, filegroup.runno, filegroup.searchno)
-            delete_concat(filegroup.recno, filegroup.runno, filegroup.searchno)
+            update_recrun(filegroup.recno, filegroup.runno, filegroup.searchno, path=path,
+                          snapshot=snapshot)
+            delete_concat(filegroup.recno, filegroup.runno, filegroup.searchno, path=path)
         else:
             insert_new_run(recno=filegroup.recno,
                                     runno=filegroup.runno,
-                                    searchno=filegroup.searchno)
-        insert_new_concat(filegroup)
+                                    searchno=filegroup.searchno,
+                                    path=path,
+                                    snapshot=snapshot)
+        insert_new_concat(filegroup, path=path, shards=written)
+        delete_checkpoints(filegroup.recno, filegroup.runno, filegroup.searchno, path=path)
 
 def stage_batch_concat(filegroup, inputdir=None, outputdir=None):
 
@@ -191,6 +410,32 @@ def file_grouper(groups, force=False, path=None, runno=None):
             filegroups.append(filegroup)
     return filegroups
 
+def group_matcher(target_str='TargetPeptideSpectrumMatch|psms', ignore=None, exclusive_groups=None):
+    """Returns a function giving the group a file name belongs to,
+    or None if it isn't a target file or its group is left out.
+    The function raises ValueError for target files without a group prefix"""
+    if ignore is None:
+        ignore = tuple()
+    pat = re.compile(r'^\d{3,5}_\d+_')
+    psms_re = re.compile(target_str, re.I)
+    run_re = re.compile(r'^\d+')
+
+    def match(name):
+        if not psms_re.search(name):
+            return None
+        group = pat.search(name)
+        if not group:
+            raise ValueError('Improper file name : {}'.format(name))
+        g = group.group()
+        g_run = int(run_re.search(g).group())
+        if any(x==g_run for x in ignore):
+            return None
+        if exclusive_groups:
+            if g_run not in exclusive_groups:
+                return None
+        return g
+    return match
+
 def file_checker(inputdir=None, outputdir=None, target_str='TargetPeptideSpectrumMatch|psms', ignore=None,
                  exclusive_groups=None, force=False, stout=None):
     """Gets groups of files"""
@@ -198,30 +443,20 @@ def file_checker(inputdir=None, outputdir=None, target_str='TargetPeptideSpectru
         inputdir = '.'
     if outputdir is None:
         outputdir = '.'
-    if ignore is None:
-        ignore = tuple()
 
-    pat = re.compile(r'^\d{3,5}_\d+_')
-    psms_re = re.compile(target_str, re.I)
-    run_re = re.compile(r'^\d+')
+    match = group_matcher(target_str, ignore=ignore, exclusive_groups=exclusive_groups)
     groups = defaultdict(list)
     #for entry in os.scandir(inputdir):
     for entry in Path(inputdir).rglob("*"):
         # if entry.is_file() and target_str in entry.name:
-        if entry.is_file() and psms_re.search(entry.name):
-            group = pat.search(entry.name)
-            if group:
-                g = group.group()
-                g_run = int(run_re.search(g).group())
-                if any(x==g_run for x in ignore):
-                    g = None
-                if exclusive_groups:
-                    if g_run not in exclusive_groups:
-                        g = None
-                if g:
-                    groups[g].append(entry)
-            else:
-                click.echo('Improper file name : {}'.format(entry.name), file=stout)
+        if entry.is_file():
+            try:
+                g = match(entry.name)
+            except ValueError as e:
+                click.echo(str(e), file=stout)
+                continue
+            if g:
+                groups[g].append(entry)
     return groups
 
 @click.group(invoke_without_command=True, context_settings=CONTEXT_SETTINGS)
@@ -246,30 +481,47 @@ def file_checker(inputdir=None, outputdir=None, target_str='TargetPeptideSpectru
 @click.option('-r', '--runno', type=int,
               help='''Constrain to a certain run number.
               Good for use in conjunction with --groups flag.''')
-def cli(ctx, ignore, force, groups, preview, source, target, log, runno):
+@click.option('--resume', is_flag=True,
+              help='Continue groups left unfinished by an interrupted run,'\
+              ' skipping input files that were already written.')
+@click.option('--shard-size', callback=size_callback,
+              help='Split each output into shards of at most this size, e.g. 2GB.')
+@click.option('--shard-rows', type=click.IntRange(min=1),
+              help='Split each output into shards of at most this many rows.')
+@click.option('--partition-by',
+              help='Split each output into one shard per value of this column,'\
+              ' e.g. "Spectrum File".')
+@click.option('--qvalue', type=float,
+              help='Keep PSMs with a q-value at or below this.')
+@click.option('--rank', type=int,
+              help='Keep PSMs of this rank.')
+def cli(ctx, ignore, force, groups, preview, source, target, log, runno, resume,
+        shard_size, shard_rows, partition_by, qvalue, rank):
+    """Settings not given as flags come from the profile of the source
+    directory, then the global configfile, then the defaults."""
 
     if source:
         source = os.path.abspath(source)
     if target:
         target = os.path.abspath(target)
+    overrides = dict(source=source, target=target, shard_size=shard_size, shard_rows=shard_rows,
+                     partition_by=partition_by, qvalue=qvalue, rank=rank)
 
     if ctx.invoked_subcommand is None:
         click.echo('Running normal batch concat', file=log)
         if (set(ignore) & set(groups)):
             click.secho('Overlap between list of experiments to ignore and group', fg='red')
             raise click.Abort
-        directories = get_directories()  # get source and target directories
-        if directories.get('source') is None and source is None:
-            directories['source'] = click.prompt('Enter source directory', default='.', type=click.Path(exists=True, file_okay=False),
-                                                 value_proc=os.path.abspath)
-        if directories.get('target') is None and target is None:
-            directories['target'] = click.prompt('Enter target directory', default='.', type=click.Path(exists=True, file_okay=False),
-                                                 value_proc=os.path.abspath)
-        if source and source != directories.get('source'):
-            update_directory(source, 'source')
-        if target and target != directories.get('target'):
-            update_directory(target, 'target')
-        fgroups = file_checker(directories.get('source'), directories.get('target'), stout=log,
+        remember_directories(source, target)
+        settings = load_settings(overrides)
+        if settings.get('source') is None:
+            settings['source'] = click.prompt('Enter source directory', default='.', type=click.Path(exists=True, file_okay=False),
+                                              value_proc=os.path.abspath)
+        if settings.get('target') is None:
+            settings['target'] = click.prompt('Enter target directory', default='.', type=click.Path(exists=True, file_okay=False),
+                                              value_proc=os.path.abspath)
+        check_shard_settings(settings)
+        fgroups = file_checker(settings['source'], settings['target'], stout=log,
                                exclusive_groups=groups, ignore=ignore)
 
         filegroups = file_grouper(fgroups, force=force, runno=runno)
@@ -294,10 +546,161 @@ def cli(ctx, ignore, force, groups, preview, source, target, log, runno):
         if len(filegroups) == 0:
             click.echo('No files to group!', file=log)
             sys.exit(0)
-        batch_concat(filegroups, outputdir=directories.get('target'))
+        batch_concat(filegroups, outputdir=settings['target'], resume=resume,
+                     shard_size=settings['shard_size'], shard_rows=settings['shard_rows'],
+                     partition_by=settings['partition_by'], qvalue=settings['qvalue'],
+                     rank=settings['rank'], settings=settings)
     else:
-        pass
-        # click.echo('Running a special function', file=log)
+        config = ctx.ensure_object(Config)
+        config.groups = groups
+        config.ignore = ignore
+        config.log = log
+        config.overrides = overrides
+
+def load_settings(overrides):
+    """Resolve the settings for this run, reporting bad values as usage errors"""
+    try:
+        return resolve_settings(overrides)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+def check_shard_settings(settings):
+    """Shards are either partitioned by a column or bounded in size, not both"""
+    if settings['partition_by'] and (settings['shard_size'] or settings['shard_rows']):
+        click.secho('Cannot both partition by a column and bound the shard size', fg='red')
+        raise click.Abort
+
+def remember_directories(source=None, target=None):
+    """Store source and target directories given on the command line for later sessions"""
+    directories = get_directories()
+    if source and source != directories.get('source'):
+        update_directory(source, 'source')
+    if target and target != directories.get('target'):
+        update_directory(target, 'target')
+
+def searchno_callback(ctx, param, value):
+    if value is None:
+        return value
+    try:
+        return searchno_policy(value)
+    except ValueError:
+        raise click.BadParameter("searchno must be a number or 'next'")
+
+@cli.command()
+@click.option('--settle', type=float,
+              help='Seconds a group has to go without changes before it is concatenated.'\
+              ' Defaults to 300.')
+@click.option('--interval', type=float,
+              help='Seconds between checks for changes. Defaults to 5.')
+@click.option('--searchno', callback=searchno_callback,
+              help="Searchno to give concatenated groups, or 'next' (the default) for one past"\
+              " the last search logged for the run.")
+@click.option('--poll', is_flag=True,
+              help='Poll for changes even if inotify is available.')
+@pass_config
+def watch(config, settle, interval, searchno, poll):
+    """Concatenate file groups automatically once their files stop changing."""
+    remember_directories(config.overrides.get('source'), config.overrides.get('target'))
+    overrides = dict(config.overrides, settle=settle, interval=interval, searchno=searchno)
+    settings = load_settings(overrides)
+    check_shard_settings(settings)
+    log = config.log
+
+    table = GroupTable(group_matcher(ignore=config.ignore, exclusive_groups=config.groups))
+    exclude = None
+    if os.path.abspath(settings['target']) != os.path.abspath(settings['source']):
+        exclude = [settings['target']]  # don't pick up our own output
+    watcher = make_watcher(settings['source'], table, poll=poll, exclude=exclude)
+    for key in table.pending():
+        check_logged(table, key)
+    click.echo('Watching {} with {} ({} group(s) pending, searchno {})'.format(settings['source'],
+                                                                        type(watcher).__name__,
+                                                                        len(table.pending()),
+                                                                        settings['searchno']), file=log)
+    try:
+        while True:
+            watcher.wait(settings['interval'])
+            for key in table.settled(settings['settle']):
+                watch_concat(table, key, settings, stout=log)
+    except KeyboardInterrupt:
+        click.echo('Stopped watching', file=log)
+
+def check_logged(table, key, path=None):
+    """Mark a group done if its files are the ones logged for one of its searches.
+    Otherwise, leave it pending to update the latest logged search once it settles"""
+    filegroup = FileGroup(table.files(key))
+    runs = logged_runs(filegroup.recno, filegroup.runno, path=path)
+    if not runs:
+        return
+    current = {file.name: (file.stat().st_size, str(datetime.fromtimestamp(file.stat().st_mtime)))
+               for file in filegroup}
+    for searchno, files in runs.items():
+        if not files or files == current:  # no files means it was added to the log by hand
+            table.searchnos[key] = searchno
+            table.mark_done(key)
+            return
+    table.searchnos[key] = max(runs)
+
+def watch_concat(table, key, settings, stout=None, path=None):
+    """Concatenate a settled group from the watch table.
+    A group keeps its searchno for the session, so fractions that land
+    after it was first concatenated update that record"""
+    filegroup = FileGroup(table.files(key))
+    if key not in table.searchnos:
+        if settings['searchno'] == 'next':
+            table.searchnos[key] = next_searchno(filegroup.recno, filegroup.runno, path=path)
+        else:
+            table.searchnos[key] = settings['searchno']
+    filegroup.searchno = table.searchnos[key]
+    filegroup.updating = previous_concat(filegroup.recno, filegroup.runno,
+                                         filegroup.searchno, path=path)
+    try:
+        batch_concat([filegroup], outputdir=settings['target'], stout=stout, resume=True, path=path,
+                     shard_size=settings['shard_size'], shard_rows=settings['shard_rows'],
+                     partition_by=settings['partition_by'], confirm=False,
+                     qvalue=settings['qvalue'], rank=settings['rank'], settings=settings)
+    except Exception as e:  # keep watching, the group is retried when its files change
+        click.secho('Could not concatenate {}: {}'.format(filegroup.name, e), fg='red', file=stout)
+    else:
+        click.secho('Concatenated {}'.format(filegroup.name), fg='green', file=stout)
+    table.mark_done(key)
+
+@cli.command('config')
+@click.option('--set', 'assignments', multiple=True, metavar='KEY=VALUE',
+              help='Store a setting, can be given more than once.')
+@click.option('--profile', is_flag=True,
+              help='Store --set settings in the profile of the source directory'\
+              ' instead of the global configfile.')
+@click.option('--diff', type=int, metavar='SNAPSHOT',
+              help='Compare the settings against those logged for an earlier run.')
+@pass_config
+def configure(config, assignments, profile, diff):
+    """Show, store and compare settings."""
+    remember_directories(config.overrides.get('source'), config.overrides.get('target'))
+    settings = load_settings(config.overrides)
+    for assignment in assignments:
+        key, _, value = assignment.partition('=')
+        key = key.strip().replace('-', '_')
+        try:
+            convert_setting(key, value.strip())
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--set')
+        if profile:
+            update_profile(settings['source'], key, value.strip())
+        else:
+            update_setting(key, value.strip())
+    if assignments:
+        settings = load_settings(config.overrides)
+    if diff is not None:
+        old = get_snapshot(diff)
+        if old is None:
+            click.secho('No snapshot {}'.format(diff), fg='red')
+            raise click.Abort
+        for key, old_value, new_value in compare_settings(old, settings):
+            click.echo('{} : {} -> {}'.format(key, old_value, new_value), file=config.log)
+        return
+    for key, value in settings.items():
+        click.echo('{} = {}'.format(key, value), file=config.log)
 
 @cli.command()
 @click.argument('recnos', nargs=-1)
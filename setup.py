@@ -12,11 +12,14 @@ package_version = calculate_version('batch_concat.py')
 setup(
     name='BatchConcat',
     version=package_version,
-    py_modules=['batch_concat', 'utils', 'test'],
+    py_modules=['batch_concat', 'utils', 'watcher', 'test'],
     install_requires=[
         'Click',
         'tqdm'
     ],
+    extras_require={
+        'inotify': ['inotify_simple'],
+    },
     entry_points="""
     [console_scripts]
     batch_concat=batch_concat:cli
@@ -1,5 +1,8 @@
 import os
+import glob
+import shutil
 import string
+import tempfile
 from io import StringIO
 import unittest
 from unittest import mock
@@ -8,6 +11,8 @@ from click.testing import CliRunner
 from batch_concat import *
 from utils import *
 from utils import __db__, __config__
+from watcher import GroupTable, Poller
+import pandas as pd
 
 thedate = datetime.strptime('1990/09/20 11:11:11', '%Y/%m/%d %H:%M:%S')
 
@@ -169,5 +174,442 @@ class BatchTest(unittest.TestCase):
         # def
         # runner = CliRunner()
         # runner.invoke(select_files(filegroup, stout=stout), input='0 1 2')
+
+def make_real_files(dirname, recno=12345, runno=1, n=3, rows=4):
+    files = list()
+    for c in string.ascii_lowercase[:n]:
+        df = pd.DataFrame({'q-Value': [0.01] * rows,
+                           'Rank': [1] * rows,
+                           'Sequence': [c] * rows,
+                           'Spectrum File': ['{}.raw'.format(c)] * rows})
+        filename = os.path.join(dirname, '{}_{}_TargetPeptideSpectrumMatch_{}.txt'.format(recno, runno, c))
+        df.to_csv(filename, index=False, sep='\t')
+        files.append(Path(filename))
+    return files
+
+def interrupt_on_last(func, arg=0):
+    """Side effect calling func, except that the run is killed
+    when argument `arg` is the last of the real files"""
+    def side_effect(*args, **kwargs):
+        if str(args[arg]).endswith('_c.txt'):
+            raise KeyboardInterrupt
+        return func(*args, **kwargs)
+    return side_effect
+
+class DatabaseTest(unittest.TestCase):
+    """A fresh database and an empty output directory"""
+    def setUp(self):
+        if os.path.exists(__db__):
+            os.remove(__db__)
+        make_database('.', stout=stout)
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.remove(__db__)
+        shutil.rmtree(self.outputdir)
+
+class ConcatTest(DatabaseTest):
+    """A group of real files to concatenate"""
+    def setUp(self):
+        super(ConcatTest, self).setUp()
+        self.filegroup = FileGroup(make_real_files(self.outputdir), 1)
+        self.outfile = os.path.join(self.outputdir, self.filegroup.name)
+        self.base = os.path.splitext(self.outfile)[0]
+
+    def interrupted_run(self, at_checkpoint=False, **kwargs):
+        """Run batch_concat, dying on the last file while reading it
+        or, with at_checkpoint, after writing it but before its checkpoint"""
+        if at_checkpoint:
+            patch = mock.patch('batch_concat.insert_checkpoint',
+                               side_effect=interrupt_on_last(insert_checkpoint, arg=1))
+        else:
+            patch = mock.patch('pandas.read_table', side_effect=interrupt_on_last(pd.read_table))
+        with patch:
+            with self.assertRaises(KeyboardInterrupt):
+                batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                             path='.', **kwargs)
+
+class CheckpointTest(ConcatTest):
+    @mock.patch('click.confirm')
+    def test_interrupted_leaves_no_output(self, mock_confirm):
+        mock_confirm.return_value = True
+        self.interrupted_run()
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertTrue(os.path.exists(self.outfile + '.part'))
+        self.assertEqual(len(get_checkpoints(12345, 1, 1, path='.')), 2)
+        self.assertFalse(previous_concat(12345, 1, 1, path='.'))
+
+    @mock.patch('click.confirm')
+    def test_resume(self, mock_confirm):
+        mock_confirm.return_value = True
+        self.interrupted_run()
+        with open(self.outfile + '.part', 'a') as f:  # half written row after the last checkpoint
+            f.write('0.01\t1')
+        with mock.patch('pandas.read_table', wraps=pd.read_table) as read_table:
+            batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                         resume=True, path='.')
+            read_files = [str(x[0][0]) for x in read_table.call_args_list]
+        self.assertFalse(any(x.endswith(('_a.txt', '_b.txt')) for x in read_files))
+        df = pd.read_table(self.outfile)
+        self.assertEqual(len(df), 12)
+        self.assertEqual(sorted(df['Sequence'].unique()), ['a', 'b', 'c'])
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+        self.assertEqual(len(get_checkpoints(12345, 1, 1, path='.')), 0)
+        self.assertTrue(previous_concat(12345, 1, 1, path='.'))
+
+    @mock.patch('click.confirm')
+    def test_no_resume_starts_over(self, mock_confirm):
+        mock_confirm.return_value = True
+        self.interrupted_run()
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout, path='.')
+        df = pd.read_table(self.outfile)
+        self.assertEqual(len(df), 12)
+
+    @mock.patch('click.confirm')
+    def test_extra_column(self, mock_confirm):
+        """Columns only a later file has are not dropped silently"""
+        mock_confirm.return_value = True
+        last = self.filegroup.files[-1]
+        df = pd.read_table(last)
+        df['Extra'] = 1
+        df.to_csv(last, index=False, sep='\t')
+        with self.assertRaisesRegex(ValueError, 'Extra'):
+            batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout, path='.')
+        self.assertFalse(os.path.exists(self.outfile))
+
+    @mock.patch('click.confirm')
+    def test_missing_column(self, mock_confirm):
+        """A later file without a column gets it filled in, like pd.concat"""
+        mock_confirm.return_value = True
+        last = self.filegroup.files[-1]
+        pd.read_table(last).drop('Sequence', axis=1).to_csv(last, index=False, sep='\t')
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout, path='.')
+        df = pd.read_table(self.outfile)
+        self.assertEqual(len(df), 12)
+        self.assertEqual(df['Sequence'].isnull().sum(), 4)
+
+class ShardTest(ConcatTest):
+    def manifest(self):
+        return pd.read_table(self.base + '.manifest')
+
+    @mock.patch('click.confirm')
+    def test_shard_rows(self, mock_confirm):
+        mock_confirm.return_value = True
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', shard_rows=5)
+        manifest = self.manifest()
+        self.assertEqual(list(manifest['rows']), [5, 5, 2])
+        for shard, rows in zip(manifest['shard'], manifest['rows']):
+            self.assertEqual(len(pd.read_table(os.path.join(self.outputdir, shard))), rows)
+        self.assertFalse(os.path.exists(os.path.join(self.outputdir, self.filegroup.name)))
+        conn = get_connection(path='.')
+        c = conn.cursor()
+        c.execute("SELECT shard from concat_files WHERE filename LIKE '%_b.txt'")
+        shard = c.fetchall()[0][0]
+        self.assertEqual(shard.split(','), list(manifest['shard'][:2]))
+
+    @mock.patch('click.confirm')
+    def test_shard_size(self, mock_confirm):
+        mock_confirm.return_value = True
+        filegroup = FileGroup(make_real_files(self.outputdir, recno=12346, rows=500), 1)
+        base = os.path.join(self.outputdir, os.path.splitext(filegroup.name)[0])
+        batch_concat([filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', shard_size=2000)
+        manifest = pd.read_table(base + '.manifest')
+        self.assertGreater(len(manifest), 1)
+        self.assertEqual(manifest['rows'].sum(), 1500)
+        row_bytes = 20  # rows here are a little under this
+        for shard, size in zip(manifest['shard'], manifest['bytes']):
+            self.assertEqual(os.path.getsize(os.path.join(self.outputdir, shard)), size)
+            self.assertLessEqual(size, 2000 + row_bytes)
+        self.assertGreater(manifest['bytes'][:-1].min(), 2000 - 2 * row_bytes)
+
+    @mock.patch('click.confirm')
+    def test_partition_by(self, mock_confirm):
+        mock_confirm.return_value = True
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', partition_by='spectrum file')
+        manifest = self.manifest()
+        self.assertEqual(len(manifest), 3)
+        for shard in manifest['shard']:
+            df = pd.read_table(os.path.join(self.outputdir, shard))
+            self.assertEqual(len(df['Spectrum File'].unique()), 1)
+            self.assertIn(df['Spectrum File'][0], shard)
+
+    @mock.patch('click.confirm')
+    def test_resume_shards(self, mock_confirm):
+        mock_confirm.return_value = True
+        self.interrupted_run(shard_rows=5)
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', shard_rows=5, resume=True)
+        self.assertEqual(list(self.manifest()['rows']), [5, 5, 2])
+
+    @mock.patch('click.confirm')
+    def test_resume_after_unchecked_write(self, mock_confirm):
+        """A crash between writing a new shard and checkpointing it"""
+        mock_confirm.return_value = True
+        self.interrupted_run(at_checkpoint=True, shard_rows=5)
+        self.assertTrue(os.path.exists(self.base + '.003.txt.part'))
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', shard_rows=5, resume=True)
+        manifest = self.manifest()
+        self.assertEqual(list(manifest['rows']), [5, 5, 2])
+        for shard, rows in zip(manifest['shard'], manifest['rows']):
+            df = pd.read_table(os.path.join(self.outputdir, shard))
+            self.assertEqual(len(df), rows)
+            self.assertNotIn('Sequence', list(df['Sequence']))  # no repeated header
+
+    @mock.patch('click.confirm')
+    def test_resume_other_mode(self, mock_confirm):
+        """Resuming with different shard settings starts over"""
+        mock_confirm.return_value = True
+        self.interrupted_run(partition_by='Spectrum File')
+        self.assertTrue(glob.glob(glob.escape(self.base) + '.*.txt.part'))
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', resume=True)
+        self.assertEqual(len(pd.read_table(self.outfile)), 12)
+        self.assertEqual(glob.glob(glob.escape(self.base) + '.*.txt*'), [])  # no partitions left
+        self.assertFalse(os.path.exists(self.base + '.manifest'))
+        self.interrupted_run(shard_rows=5)
+        batch_concat([self.filegroup], outputdir=self.outputdir, stout=stout,
+                     path='.', resume=True, shard_rows=4)
+        self.assertEqual(list(self.manifest()['rows']), [4, 4, 4])
+
+class WatchTest(DatabaseTest):
+    def setUp(self):
+        super(WatchTest, self).setUp()
+        self.sourcedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(WatchTest, self).tearDown()
+        shutil.rmtree(self.sourcedir)
+
+    def test_settled(self):
+        table = GroupTable(group_matcher())
+        files = make_real_files(self.sourcedir)
+        for file in files[:2]:
+            table.update(file, changed=100)
+        self.assertIsNone(table.update(files[0], changed=200))  # unchanged
+        table.update(os.path.join(self.sourcedir, 'notes.txt'))
+        self.assertEqual(list(table.groups), ['12345_1_'])
+        self.assertEqual(table.settled(60, now=150), [])
+        self.assertEqual(table.settled(60, now=160), ['12345_1_'])
+        table.mark_done('12345_1_')
+        self.assertEqual(table.settled(60, now=1000), [])
+        self.assertEqual(table.update(files[2], changed=1000), '12345_1_')
+        self.assertEqual(table.settled(60, now=1010), [])
+        self.assertEqual(len(table.files('12345_1_')), 3)
+
+    def test_poller(self):
+        make_real_files(self.sourcedir, recno=12345)
+        table = GroupTable(group_matcher())
+        poller = Poller(self.sourcedir, table)
+        self.assertEqual(len(table.files('12345_1_')), 3)
+        subdir = os.path.join(self.sourcedir, 'run2')
+        os.mkdir(subdir)
+        make_real_files(subdir, recno=12346, n=2)
+        poller.poll()
+        self.assertEqual(len(table.files('12346_1_')), 2)
+        os.remove(table.files('12346_1_')[0])
+        poller.poll()
+        self.assertEqual(len(table.files('12346_1_')), 1)
+
+    def test_scan_watches_before_listing(self):
+        """A file created as a directory starts being watched is not missed"""
+        class LatePoller(Poller):
+            def add_dir(self, directory, mtime):
+                super(LatePoller, self).add_dir(directory, mtime)
+                make_real_files(directory, n=1)
+        table = GroupTable(group_matcher())
+        LatePoller(self.sourcedir, table)
+        self.assertEqual(len(table.files('12345_1_')), 1)
+
+    def test_ignores_output(self):
+        files = make_real_files(self.sourcedir)
+        table = GroupTable(group_matcher())
+        targetdir = os.path.join(self.sourcedir, 'target')
+        os.mkdir(targetdir)
+        make_real_files(targetdir, recno=12346)
+        poller = Poller(self.sourcedir, table, exclude=[targetdir])
+        self.assertEqual(list(table.groups), ['12345_1_'])
+        for name in ('12345_1_1_TargetPeptideSpectrumMatch_all.txt',
+                     '12345_1_1_TargetPeptideSpectrumMatch_all.txt.part',
+                     '12345_1_1_TargetPeptideSpectrumMatch_all.002.txt',
+                     '12345_1_1_TargetPeptideSpectrumMatch_all.a.raw.txt.part',
+                     '12345_1_1_TargetPeptideSpectrumMatch_all.manifest'):
+            open(os.path.join(self.sourcedir, name), 'w').close()
+        poller.poll()
+        self.assertEqual(table.files('12345_1_'), sorted(files))
+
+    def test_watch_concat(self):
+        make_real_files(self.sourcedir)
+        table = GroupTable(group_matcher())
+        Poller(self.sourcedir, table)
+        settings = resolve_settings({'target': self.outputdir}, path=self.sourcedir)
+        insert_new_run(12345, 1, 1, path='.')
+        watch_concat(table, '12345_1_', settings, stout=stout, path='.')
+        self.assertTrue(previous_concat(12345, 1, 2, path='.'))
+        self.assertEqual(table.pending(), [])
+        outfile = os.path.join(self.outputdir, '12345_1_2_TargetPeptideSpectrumMatch_all.txt')
+        self.assertEqual(len(pd.read_table(outfile)), 12)
+
+    def test_watch_concat_keeps_searchno(self):
+        """A fraction landing after the group settled updates the same search"""
+        files = make_real_files(self.sourcedir)
+        os.rename(files[2], os.path.join(self.outputdir, files[2].name))
+        table = GroupTable(group_matcher())
+        poller = Poller(self.sourcedir, table)
+        settings = resolve_settings({'target': self.outputdir}, path=self.sourcedir)
+        watch_concat(table, '12345_1_', settings, stout=stout, path='.')
+        os.rename(os.path.join(self.outputdir, files[2].name), files[2])
+        poller.poll()
+        self.assertEqual(table.pending(), ['12345_1_'])
+        watch_concat(table, '12345_1_', settings, stout=stout, path='.')
+        self.assertTrue(previous_concat(12345, 1, 1, path='.'))
+        self.assertFalse(previous_concat(12345, 1, 2, path='.'))
+        outfile = os.path.join(self.outputdir, '12345_1_1_TargetPeptideSpectrumMatch_all.txt')
+        self.assertEqual(len(pd.read_table(outfile)), 12)
+        conn = get_connection(path='.')
+        c = conn.cursor()
+        c.execute("SELECT 1 from concat_files")
+        self.assertEqual(len(c.fetchall()), 3)
+
+    @mock.patch('click.confirm')
+    def test_snapshot_after_confirm(self, mock_confirm):
+        files = make_real_files(self.sourcedir)
+        settings = resolve_settings(path=self.sourcedir)
+        mock_confirm.return_value = False
+        with self.assertRaises(SystemExit):
+            batch_concat([FileGroup(files, 1)], outputdir=self.outputdir, stout=stout,
+                         path='.', settings=settings)
+        self.assertIsNone(get_snapshot(1, path='.'))
+        mock_confirm.return_value = True
+        batch_concat([FileGroup(files, 1)], outputdir=self.outputdir, stout=stout,
+                     path='.', settings=settings)
+        self.assertEqual(get_snapshot(1, path='.'), settings)
+        conn = get_connection(path='.')
+        c = conn.cursor()
+        c.execute("SELECT snapshot from exprun WHERE recno=? AND runno=? AND searchno=?", (12345, 1, 1))
+        self.assertEqual(c.fetchall(), [(1,)])
+
+    def test_check_logged(self):
+        """A fraction that lands while watch is stopped is picked up on restart"""
+        files = make_real_files(self.sourcedir)
+        late = os.path.join(self.outputdir, files[2].name)
+        os.rename(files[2], late)
+        table = GroupTable(group_matcher())
+        Poller(self.sourcedir, table)
+        settings = resolve_settings({'target': self.outputdir}, path=self.sourcedir)
+        watch_concat(table, '12345_1_', settings, stout=stout, path='.')
+
+        table = GroupTable(group_matcher())  # restarted, nothing new
+        Poller(self.sourcedir, table)
+        check_logged(table, '12345_1_', path='.')
+        self.assertEqual(table.pending(), [])
+
+        os.rename(late, files[2])
+        table = GroupTable(group_matcher())  # restarted after the last fraction landed
+        Poller(self.sourcedir, table)
+        check_logged(table, '12345_1_', path='.')
+        self.assertEqual(table.pending(), ['12345_1_'])
+        self.assertEqual(table.searchnos['12345_1_'], 1)
+        watch_concat(table, '12345_1_', settings, stout=stout, path='.')
+        self.assertFalse(previous_concat(12345, 1, 2, path='.'))
+        outfile = os.path.join(self.outputdir, '12345_1_1_TargetPeptideSpectrumMatch_all.txt')
+        self.assertEqual(len(pd.read_table(outfile)), 12)
+
+        table = GroupTable(group_matcher())
+        Poller(self.sourcedir, table)
+        check_logged(table, '12345_1_', path='.')
+        self.assertEqual(table.pending(), [])
+
+    def test_check_logged_by_hand(self):
+        make_real_files(self.sourcedir)
+        insert_new_run(12345, 1, 3, path='.')  # as with the add command
+        table = GroupTable(group_matcher())
+        Poller(self.sourcedir, table)
+        check_logged(table, '12345_1_', path='.')
+        self.assertEqual(table.pending(), [])
+
+    def test_watch_shard_settings(self):
+        config = Config()
+        config.overrides = dict(source=self.sourcedir, target=self.outputdir,
+                                shard_size=2**30, partition_by='Spectrum File')
+        settings = resolve_settings(config.overrides, path=self.sourcedir)
+        with mock.patch('batch_concat.remember_directories'), \
+             mock.patch('batch_concat.resolve_settings', return_value=settings), \
+             mock.patch('batch_concat.make_watcher') as make_watcher:
+            result = CliRunner().invoke(watch, ['--settle', '1'], obj=config)
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('Cannot both partition', result.output)
+        make_watcher.assert_not_called()
+
+class SettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_layers(self):
+        self.assertEqual(resolve_settings(path=self.path)['qvalue'], 0.05)
+        update_setting('qvalue', '0.01', path=self.path)
+        update_setting('shard_size', '1GB', path=self.path)
+        update_profile('/data/project', 'qvalue', '0.02', path=self.path)
+        settings = resolve_settings(path=self.path)
+        self.assertEqual(settings['qvalue'], 0.01)
+        self.assertEqual(settings['shard_size'], 2**30)
+        settings = resolve_settings({'source': '/data/project', 'rank': None}, path=self.path)
+        self.assertEqual(settings['qvalue'], 0.02)
+        self.assertEqual(settings['rank'], 1)
+        settings = resolve_settings({'source': '/data/project', 'qvalue': 0.03}, path=self.path)
+        self.assertEqual(settings['qvalue'], 0.03)
+
+    def test_profile_absolute(self):
+        project = os.path.join(self.path, 'project')
+        os.mkdir(project)
+        cwd = os.getcwd()
+        os.chdir(project)
+        try:
+            update_profile('.', 'rank', '2', path=self.path)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(resolve_settings({'source': project}, path=self.path)['rank'], 2)
+        self.assertEqual(resolve_settings({'source': '.'}, path=self.path)['rank'], 1)
+
+    def test_configfile_read_once(self):
+        parser = get_parser(path=self.path)
+        update_setting('rank', '2', path=self.path)
+        with mock.patch.object(ConfigParser, 'read') as read:
+            self.assertIs(get_parser(path=self.path), parser)
+            self.assertEqual(resolve_settings(path=self.path)['rank'], 2)
+            read.assert_not_called()
+
+    def test_bad_setting(self):
+        with self.assertRaises(ValueError):
+            update_profile('/data/project', 'qvalu', '0.01', path=self.path)
+        with self.assertRaises(ValueError):
+            update_profile('/data/project', 'searchno', 'last', path=self.path)
+        for key, value in (('shard_rows', '-1'), ('shard_size', '0'), ('settle', '-5'),
+                           ('interval', '0'), ('qvalue', '2'), ('searchno', '0')):
+            with self.assertRaises(ValueError):
+                update_setting(key, value, path=self.path)
+            with self.assertRaises(ValueError):
+                resolve_settings({key: value}, path=self.path)
+
+    def test_bad_configfile(self):
+        parser = get_parser(path=self.path)
+        parser['output'] = {'shard_rows': '-1'}  # as if edited by hand
+        with self.assertRaises(ValueError):
+            resolve_settings(path=self.path)
+
+    def test_snapshot(self):
+        settings = resolve_settings(path=self.path)
+        snapshot = insert_snapshot(settings, path=self.path)
+        self.assertEqual(get_snapshot(snapshot, path=self.path), settings)
+        settings['qvalue'] = 0.01
+        self.assertEqual(compare_settings(get_snapshot(snapshot, path=self.path), settings),
+                         [('qvalue', 0.05, 0.01)])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,7 @@
 import os
 import re
+import json
+from collections import OrderedDict
 from datetime import datetime
 import sqlite3 as sql
 from configparser import ConfigParser
@@ -8,7 +10,8 @@ import click
 __config__  = 'batch_concat.ini'
 __db__ = 'batch_concat.sqlite'
 __basedir__ = os.path.expanduser('~')
-parser = ConfigParser()
+_parsers = dict()  # configfile -> ConfigParser, so each file is read once per process
+_profiles = dict()  # (path, source) -> settings stored for that source directory
 
 def identify_column(columns, pat):
     """Identify a column in a list of columns"""
@@ -17,12 +20,12 @@ def identify_column(columns, pat):
         raise ValueError('Cannot match columns correctly.')
     return matches[0]
 
-def filter_output(df):
+def filter_output(df, qvalue=0.05, rank=1):
     '''Filter the file output because PD2.0 doesn't do it '''
     q_pat = re.compile('q\s?-?value', re.IGNORECASE)
     q_value_col = identify_column(df.columns, q_pat)
-    return df[(df[q_value_col] <= 0.05) &
-              (df['Rank'] == 1)]
+    return df[(df[q_value_col] <= qvalue) &
+              (df['Rank'] == rank)]
 
 def make_database(path, stout=None):
     click.echo('Making a new database.', file=stout)
@@ -37,7 +40,8 @@ def make_database(path, stout=None):
     runno INTEGER NOT NULL,
     searchno INTEGER NOT NULL,
     creation_ts timestamp,
-    modification_ts timestamp
+    modification_ts timestamp,
+    snapshot INTEGER
     )""")
     conn.execute("""CREATE TABLE concat_files(
     ID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,12 +49,54 @@ def make_database(path, stout=None):
     filename STRING,
     filesize REAL,
     filedate DATE,
+    shard STRING,
     FOREIGN KEY(rec_run) REFERENCES EXPRUN(id)
     )""")
+    update_database(conn)
     conn.commit()
     conn.close()
     click.secho('New database created', fg='green', file=stout)
 
+def update_database(conn):
+    """Bring a database made by an older version up to date.
+    Safe to call on a database that is already current."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS checkpoints(
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    recno INTEGER NOT NULL,
+    runno INTEGER NOT NULL,
+    searchno INTEGER NOT NULL,
+    filename STRING,
+    filesize REAL,
+    filedate timestamp,
+    shard STRING,
+    outputsize INTEGER,
+    shardrows INTEGER,
+    mode STRING
+    )""")
+    add_missing_columns(conn, 'checkpoints', (('shard', 'STRING'),
+                                              ('shardrows', 'INTEGER'),
+                                              ('mode', 'STRING')))
+    add_missing_columns(conn, 'concat_files', (('shard', 'STRING'),))
+    conn.execute("""CREATE TABLE IF NOT EXISTS profiles(
+    source STRING NOT NULL,
+    key STRING NOT NULL,
+    value STRING,
+    PRIMARY KEY(source, key)
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS snapshots(
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    creation_ts timestamp,
+    settings STRING
+    )""")
+    add_missing_columns(conn, 'exprun', (('snapshot', 'INTEGER'),))
+
+def add_missing_columns(conn, table, columns):
+    """Add (name, type) columns to table if it doesn't have them yet"""
+    existing = [x[1] for x in conn.execute('PRAGMA table_info({})'.format(table))]
+    for name, kind in columns:
+        if name not in existing:
+            conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, kind))
+
 def get_connection(path=None):
     """Return a connection to the sql database"""
     if path is None:
@@ -58,9 +104,11 @@ def get_connection(path=None):
     db = os.path.join(path, __db__)
     if not os.path.isfile(db):
         make_database(path)
-    return sql.connect(db, detect_types=sql.PARSE_DECLTYPES)
+    conn = sql.connect(db, detect_types=sql.PARSE_DECLTYPES)
+    update_database(conn)
+    return conn
 
-def insert_new_run(recno=None, runno=None, searchno=None, path=None):
+def insert_new_run(recno=None, runno=None, searchno=None, path=None, snapshot=None):
     """Insert a new run into the database"""
     conn = get_connection(path=path)
     c = conn.cursor()
@@ -71,13 +119,16 @@ def insert_new_run(recno=None, runno=None, searchno=None, path=None):
         click.secho('Warning: Record already exists', fg='red')
         conn.close()
         return
-    c.execute("""INSERT into exprun(recno, runno, searchno, creation_ts, modification_ts)
-    values (?, ?, ?, ?, ?)""", (recno, runno, searchno, datetime.now(), datetime.now()))
+    c.execute("""INSERT into exprun(recno, runno, searchno, creation_ts, modification_ts, snapshot)
+    values (?, ?, ?, ?, ?, ?)""", (recno, runno, searchno, datetime.now(), datetime.now(), snapshot))
     conn.commit()
     conn.close()
 
-def insert_new_concat(filestruct, path=None):
-    """Insert a new file that is being batch_concatenated"""
+def insert_new_concat(filestruct, path=None, shards=None):
+    """Insert a new file that is being batch_concatenated.
+    `shards` optionally maps each filename to the output shards its rows went to"""
+    if shards is None:
+        shards = dict()
     conn = get_connection(path=path)
     c = conn.cursor()
     c.execute("""SELECT id from exprun WHERE
@@ -88,8 +139,9 @@ def insert_new_concat(filestruct, path=None):
     for file in filestruct.files:
         size = file.stat().st_size
         dt = file.stat().st_mtime
-        c.execute("""INSERT into concat_files(rec_run, filename, filesize, filedate)
-        VALUES (?, ?, ?, ?)""", (rec_run, file.name, size, datetime.fromtimestamp(dt)))
+        shard = ','.join(shards.get(file.name, [])) or None
+        c.execute("""INSERT into concat_files(rec_run, filename, filesize, filedate, shard)
+        VALUES (?, ?, ?, ?, ?)""", (rec_run, file.name, size, datetime.fromtimestamp(dt), shard))
     conn.commit()
     conn.close()
 
@@ -110,16 +162,43 @@ def previous_concat(recno=None, runno=None, searchno=None, path=None):
     else:
         return False
 
-def update_recrun(recno=None, runno=None, searchno=None, path=None):
-    """Update the exprun table with new timestamp"""
+def logged_runs(recno=None, runno=None, path=None):
+    """Return the files logged for each search of recno and runno as
+    {searchno: {filename: (filesize, filedate as text)}}"""
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("""SELECT exprun.searchno, concat_files.filename, concat_files.filesize,
+    CAST(concat_files.filedate AS TEXT)
+    FROM exprun LEFT JOIN concat_files ON concat_files.rec_run = exprun.id
+    WHERE exprun.recno=? AND exprun.runno=?""", (recno, runno))
+    runs = dict()
+    for searchno, filename, filesize, filedate in c.fetchall():
+        files = runs.setdefault(searchno, dict())
+        if filename is not None:
+            files[filename] = (filesize, filedate)
+    conn.close()
+    return runs
+
+def update_recrun(recno=None, runno=None, searchno=None, path=None, snapshot=None):
+    """Update the exprun table with new timestamp and settings snapshot"""
     conn = get_connection(path=path)
     c = conn.cursor()
     c.execute("""UPDATE exprun
-    SET modification_ts=?
-    WHERE recno=? AND runno=? AND searchno=?""", (datetime.now(), recno, runno, searchno))
+    SET modification_ts=?, snapshot=COALESCE(?, snapshot)
+    WHERE recno=? AND runno=? AND searchno=?""", (datetime.now(), snapshot, recno, runno, searchno))
     conn.commit()
     conn.close()
 
+def next_searchno(recno=None, runno=None, path=None):
+    """One past the highest searchno logged for recno and runno"""
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("SELECT MAX(searchno) from exprun where recno=? and runno=?",
+              (recno, runno))
+    searchno = c.fetchall()[0][0]
+    conn.close()
+    return (searchno or 0) + 1
+
 def delete_concat(recno=None, runno=None, searchno=None, path=None):
 
     conn = get_connection(path=path)
@@ -145,6 +224,43 @@ def delete_recrun(recno=None, runno=None, searchno=None, path=None):
     conn.commit()
     conn.close()
 
+def insert_checkpoint(filegroup, file, shards, path=None, mode=None):
+    """Record that `file` has been fully appended to the partial output of
+    `filegroup`. `shards` maps each output shard the file was written to
+    onto the (bytes, rows) of that shard afterwards, and `mode` describes
+    how the output is split into shards"""
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    filedate = datetime.fromtimestamp(file.stat().st_mtime)
+    rows = [(shard, size, nrows) for shard, (size, nrows) in shards.items()] or [(None, None, None)]
+    for shard, size, nrows in rows:
+        c.execute("""INSERT into checkpoints(recno, runno, searchno, filename, filesize, filedate,
+        shard, outputsize, shardrows, mode)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (filegroup.recno, filegroup.runno, filegroup.searchno,
+                                                   file.name, file.stat().st_size, filedate,
+                                                   shard, size, nrows, mode))
+    conn.commit()
+    conn.close()
+
+def get_checkpoints(recno=None, runno=None, searchno=None, path=None):
+    """Return the checkpoints for a group as a list of
+    (filename, filesize, filedate, shard, outputsize, shardrows, mode) tuples in the order written"""
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("""SELECT filename, filesize, filedate, shard, outputsize, shardrows, mode from checkpoints
+    WHERE recno=? AND runno=? AND searchno=? ORDER BY id""", (recno, runno, searchno))
+    fetch = c.fetchall()
+    conn.close()
+    return fetch
+
+def delete_checkpoints(recno=None, runno=None, searchno=None, path=None):
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("""DELETE FROM checkpoints WHERE
+    recno=? AND runno=? AND searchno=?""", (recno, runno, searchno))
+    conn.commit()
+    conn.close()
+
 def make_configfile(path=None):
     """Make a configfile with necessary sections.
     Default places it in os.path.expanduser home directory"""
@@ -152,32 +268,45 @@ def make_configfile(path=None):
         path = os.path.join(__basedir__, '.batch_concat')
     if not os.path.isdir(path):
         os.mkdir(path)
+    parser = ConfigParser()
     parser['directories'] = {'source': '.',
                              'target': '.'}
     with open(os.path.join(path, __config__), 'w') as configfile:
         parser.write(configfile)
 
 def get_parser(path=None):
-    """Get the parser for the configfile"""
+    """Get the parser for the configfile.
+    The file is only read the first time, later calls share the same parser"""
     if path is None:
         path = os.path.join(__basedir__, '.batch_concat')
     configfile = os.path.join(path, __config__)
-    if not os.path.isfile(configfile):
-        make_configfile(path)
-    parser.read(configfile)
-    return parser
+    if configfile not in _parsers:
+        if not os.path.isfile(configfile):
+            make_configfile(path)
+        parser = ConfigParser()
+        parser.read(configfile)
+        _parsers[configfile] = parser
+    return _parsers[configfile]
 
 def update_directory(directory, category, path=None):
 
-    parser = get_parser(path=path)
-    parser['directories'][category] = directory
-    update_config(parser)
+    update_setting(category, directory, path=path)
 
 def get_directories(path=None):
 
     parser = get_parser(path=path)
     return parser['directories']
 
+def update_setting(key, value, path=None):
+    """Store a setting in the global configfile"""
+    convert_setting(key, value)  # make sure it is valid before storing
+    section = SETTINGS[key][0]
+    parser = get_parser(path=path)
+    if not parser.has_section(section):
+        parser.add_section(section)
+    parser[section][key] = '' if value is None else str(value)
+    update_config(parser, path=path)
+
 def update_config(parser, path=None):
 
     if path is None:
@@ -185,6 +314,89 @@ def update_config(parser, path=None):
     with open(os.path.join(path, __config__), 'w') as configfile:
         parser.write(configfile)
 
+def convert_setting(key, value):
+    """Convert a setting read from the configfile or a profile to its type.
+    Raises ValueError for unknown settings and values that don't convert
+    or are out of range"""
+    if key not in SETTINGS:
+        raise ValueError('Unknown setting {}'.format(key))
+    if value is None or value == '':
+        return None
+    _, kind, _, check = SETTINGS[key]
+    converted = kind(value)
+    if check is not None and not check(converted):
+        raise ValueError('Invalid value for {} : {}'.format(key, value))
+    return converted
+
+def get_profile(source, path=None):
+    """Return the settings stored for a source directory"""
+    source = os.path.abspath(source)
+    if (path, source) not in _profiles:
+        conn = get_connection(path=path)
+        c = conn.cursor()
+        c.execute("SELECT key, value from profiles WHERE source=?", (source,))
+        _profiles[(path, source)] = {key: convert_setting(key, value) for key, value in c.fetchall()}
+        conn.close()
+    return _profiles[(path, source)]
+
+def update_profile(source, key, value, path=None):
+    """Store a setting for a source directory"""
+    source = os.path.abspath(source)
+    convert_setting(key, value)  # make sure it is valid before storing
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("DELETE FROM profiles WHERE source=? AND key=?", (source, key))
+    c.execute("INSERT into profiles(source, key, value) VALUES (?, ?, ?)",
+              (source, key, '' if value is None else str(value)))
+    conn.commit()
+    conn.close()
+    _profiles.pop((path, source), None)
+
+def resolve_settings(overrides=None, path=None):
+    """Resolve the settings for a run, each layer taking precedence over the last:
+    defaults, the global configfile, the profile of the source directory,
+    and `overrides` (usually cli flags, where None means not given).
+    Raises ValueError for settings that are unknown or out of range"""
+    settings = OrderedDict((key, default) for key, (_, _, default, _) in SETTINGS.items())
+    parser = get_parser(path=path)
+    for key, (section, _, _, _) in SETTINGS.items():
+        if parser.has_option(section, key):
+            settings[key] = convert_setting(key, parser.get(section, key))
+    overrides = {key: convert_setting(key, value) for key, value in (overrides or dict()).items()
+                 if value is not None}
+    source = overrides.get('source') or settings['source']
+    if source:
+        settings.update(get_profile(source, path=path))
+    settings.update(overrides)
+    return settings
+
+def insert_snapshot(settings, path=None):
+    """Log the resolved settings of a run, returning the snapshot id"""
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("""INSERT into snapshots(creation_ts, settings)
+    VALUES (?, ?)""", (datetime.now(), json.dumps(settings, sort_keys=True)))
+    snapshot = c.lastrowid
+    conn.commit()
+    conn.close()
+    return snapshot
+
+def get_snapshot(snapshot, path=None):
+    """Return the settings logged under a snapshot id, or None"""
+    conn = get_connection(path=path)
+    c = conn.cursor()
+    c.execute("SELECT settings from snapshots WHERE id=?", (snapshot,))
+    fetch = c.fetchall()
+    conn.close()
+    if not fetch:
+        return None
+    return json.loads(fetch[0][0])
+
+def compare_settings(old, new):
+    """List the (key, old value, new value) of settings that differ"""
+    return [(key, old.get(key), new.get(key)) for key in sorted(set(old) | set(new))
+            if old.get(key) != new.get(key)]
+
 def display(filegroup, to_display=None, stout=None):
     click.echo('\nGroup : {}'.format(filegroup.name), file=stout)
     for ix, file in enumerate(filegroup.files):
@@ -209,6 +421,33 @@ def select_files(filegroup, stout=None):
     filegroup.filter_files([int(x) for x in to_display])
     #click.prompt
 
+def parse_size(size):
+    """Parse a human readable size such as '500MB' or '2g' into bytes"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', str(size), re.I)
+    if not match:
+        raise ValueError('Cannot parse size {}'.format(size))
+    power = ' kmgt'.index(match.group(2).lower() or ' ')
+    return int(float(match.group(1)) * 2**(10*power))
+
+def searchno_policy(value):
+    """A searchno, or 'next' for one past the last search logged for the run"""
+    if str(value).lower() == 'next':
+        return 'next'
+    return int(value)
+
+SETTINGS = OrderedDict([  # key -> (configfile section, type, default, check on the value)
+    ('source', ('directories', str, '.', None)),
+    ('target', ('directories', str, '.', None)),
+    ('qvalue', ('filter', float, 0.05, lambda x: 0 <= x <= 1)),
+    ('rank', ('filter', int, 1, lambda x: x >= 1)),
+    ('shard_size', ('output', parse_size, None, lambda x: x > 0)),
+    ('shard_rows', ('output', int, None, lambda x: x >= 1)),
+    ('partition_by', ('output', str, None, None)),
+    ('searchno', ('watch', searchno_policy, 'next', lambda x: x == 'next' or x >= 1)),
+    ('settle', ('watch', float, 300, lambda x: x >= 0)),
+    ('interval', ('watch', float, 5, lambda x: x > 0)),
+])
+
 def byte_formatter(b):
     conv = b/(2**10)
     if conv < 1000:
@@ -0,0 +1,185 @@
+"""Keep track of file groups in a source directory as their files
+are written, so that a group can be concatenated once it has settled.
+Uses inotify through the optional inotify_simple package where available,
+otherwise polls for changed modification times."""
+import os
+import re
+import stat
+import time
+from pathlib import Path
+from collections import defaultdict
+
+try:
+    from inotify_simple import INotify, flags
+except (ImportError, OSError):  # not installed or not on linux
+    INotify = None
+
+# concatenated outputs, their shards, partial writes and manifests
+output_re = re.compile(r'(all(\.[^/]+)?\.txt(\.part)?|\.manifest(\.part)?)$')
+
+def is_output(name):
+    """True for files batch_concat writes, which are never inputs"""
+    return bool(output_re.search(name))
+
+class GroupTable(object):
+    """In memory table of file groups, updated one path at a time"""
+
+    def __init__(self, classify):
+        self.classify = classify  # file name -> group key or None
+        self.groups = defaultdict(dict)  # group key -> {path: (size, mtime)}
+        self.changed = dict()  # group key -> time of last change
+        self.done = set()  # groups that have not changed since being concatenated
+        self.searchnos = dict()  # group key -> searchno given to it this session
+
+    def update(self, path, changed=None):
+        """Record the current state of path.
+        Returns the key of its group if this is a change, else None"""
+        path = Path(path)
+        if is_output(path.name):
+            return None
+        try:
+            key = self.classify(path.name)
+        except ValueError:
+            return None
+        if key is None:
+            return None
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            state = None
+        else:
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            state = (st.st_size, st.st_mtime)
+        files = self.groups[key]
+        if files.get(path) == state:
+            return None
+        if state is None:
+            files.pop(path, None)
+        else:
+            files[path] = state
+        if changed is None:
+            changed = time.time()
+        self.changed[key] = max(self.changed.get(key, 0), changed)
+        self.done.discard(key)
+        return key
+
+    def files(self, key):
+        return sorted(self.groups[key])
+
+    def pending(self):
+        return [key for key, files in self.groups.items()
+                if files and key not in self.done]
+
+    def settled(self, settle, now=None):
+        """Groups that are pending and have not changed for `settle` seconds"""
+        if now is None:
+            now = time.time()
+        return [key for key in self.pending() if now - self.changed[key] >= settle]
+
+    def mark_done(self, key):
+        self.done.add(key)
+
+class Poller(object):
+    """Finds changes by comparing modification times.
+    Only directories whose mtime changed are listed again,
+    and only the files of pending groups are stat'ed on each poll.
+    Directories in `exclude`, such as the target directory, are not watched"""
+
+    def __init__(self, root, table, exclude=None):
+        self.table = table
+        self.dirs = dict()  # directory -> mtime
+        self.exclude = {os.path.abspath(x) for x in exclude or tuple()}
+        self.root = root
+        self.scan(root, initial=True)
+
+    def add_dir(self, directory, mtime):
+        self.dirs[directory] = mtime
+
+    def scan(self, directory, initial=False):
+        """Walk directory, adding everything below it to the table.
+        On the initial scan, files count as changed at their own mtime.
+        The directory is added before it is listed, so nothing created
+        in between is missed by an inotify watch"""
+        if os.path.abspath(directory) in self.exclude:
+            return
+        try:
+            self.add_dir(directory, os.stat(directory).st_mtime)
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            self.dirs.pop(directory, None)
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.scan(entry.path, initial=initial)
+            elif entry.is_file():
+                self.table.update(entry.path,
+                                  changed=entry.stat().st_mtime if initial else None)
+
+    def list_dir(self, directory):
+        """Pick up new files and directories in a directory that changed"""
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self.dirs:  # excluded ones are skipped by scan
+                    self.scan(entry.path)
+            elif entry.is_file():
+                self.table.update(entry.path)
+
+    def poll(self):
+        for directory, mtime in list(self.dirs.items()):
+            try:
+                new_mtime = os.stat(directory).st_mtime
+            except FileNotFoundError:
+                del self.dirs[directory]
+                continue
+            if new_mtime != mtime:
+                self.dirs[directory] = new_mtime
+                self.list_dir(directory)
+        for key in self.table.pending():  # catch files still being written
+            for path in self.table.files(key):
+                self.table.update(path)
+
+    def wait(self, timeout):
+        """Wait for timeout seconds, then update the table"""
+        time.sleep(timeout)
+        self.poll()
+
+class INotifyWatcher(Poller):
+    """Updates the table from inotify events"""
+
+    def __init__(self, root, table, exclude=None):
+        self.inotify = INotify()
+        self.mask = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE |
+                     flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE)
+        self.watches = dict()  # watch descriptor -> directory
+        super(INotifyWatcher, self).__init__(root, table, exclude=exclude)
+
+    def add_dir(self, directory, mtime):
+        super(INotifyWatcher, self).add_dir(directory, mtime)
+        if directory not in self.watches.values():
+            self.watches[self.inotify.add_watch(directory, self.mask)] = directory
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events and apply them to the table"""
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:  # events were lost, look at everything again
+                self.scan(self.root)
+                continue
+            directory = self.watches.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self.scan(path)
+                continue
+            self.table.update(path)
+
+def make_watcher(root, table, poll=False, exclude=None):
+    """inotify if available, otherwise a Poller"""
+    if INotify is not None and not poll:
+        try:
+            return INotifyWatcher(root, table, exclude=exclude)
+        except OSError:  # e.g. out of inotify watches
+            pass
+    return Poller(root, table, exclude=exclude)